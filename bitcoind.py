@@ -5,9 +5,11 @@ import sys
 import time
 import asyncio
 import aiohttp
-import json
+import orjson
 import base64
+import itertools
 import http.client
+import multidict
 
 import utils
 
@@ -24,7 +26,7 @@ class BitcoindClient():
         RPC requests to a bitcoind instance.
     """
 
-    def __init__(self, bitcoin_host, bitcoin_port, bitcoin_user, bitcoin_pass):
+    def __init__(self, bitcoin_host, bitcoin_port, bitcoin_user, bitcoin_pass, batch_size= 25):
         self._bitcoin_host = str(bitcoin_host)
         self._bitcoin_port = int(bitcoin_port)
         self._bitcoin_user = str(bitcoin_user)
@@ -34,17 +36,18 @@ class BitcoindClient():
 
         # Precompute authentication headers
         auth = "Basic " + base64.b64encode((self._bitcoin_user+":"+self._bitcoin_pass).encode('utf8') ).decode('utf8')
-        self._request_headers = {
+        self._request_headers = multidict.CIMultiDict({
             "Content-Type": "application/json",
             "Authorization": auth
-        }
+        })
 
-        self._request_count = 0
+        self._request_ids = itertools.count(1)
 
         conn = aiohttp.TCPConnector(limit= 8)
         self._session = aiohttp.ClientSession(connector= conn)
 
-        self._queue = utils.WorkQueue(self._process_http, max_queue_size= 10000, workers= 8)
+        # Requests waiting in the queue are sent together as JSON-RPC batches
+        self._queue = utils.WorkQueue(batch_processing_func= self._process_http, max_queue_size= 10000, workers= 8, batch_size= batch_size)
         self._queue.start()
 
     @staticmethod
@@ -80,40 +83,53 @@ class BitcoindClient():
         # Awaits: first one until request is enqueued, second one until it gets processed
         return await (await self._queue.enqueue((method, body)))
 
-    async def _process_http(self, payload):
+    async def _process_http(self, payloads):
         """ Work queue processing method.
-            Sends a request and reads the response.
+            Sends requests in a single JSON-RPC batch and reads the responses.
 
             Arguments:
-            payload -- (method, body) tuple
-        """
-
-        (method, body) = payload 
+            payloads -- list of (method, body) tuples
 
-        self._request_count+= 1
+            Returns a list of results in the same order, holding
+            a BitcoindHttpException for each request that failed.
+        """
 
-        request_json = {
+        requests = []
+        for (method, body) in payloads:
+            requests.append({
                 "jsonrpc": "1.0",
-                "id": str(self._request_count), 
+                "id": next(self._request_ids), 
                 "method": method,
                 "params": body
-        }
+            })
 
-        async with self._session.post(self._url, json= request_json, headers= self._request_headers) as resp:
+        # Don't wrap a lone request into a batch
+        request_json = requests if len(requests) > 1 else requests[0]
+        request_bytes = orjson.dumps(request_json)
+
+        async with self._session.post(self._url, data= request_bytes, headers= self._request_headers) as resp:
             try:
-                response_txt = await resp.text()
-                response_obj = json.loads(response_txt)
+                response_bytes = await resp.read()
+                response_obj = orjson.loads(response_bytes)
 
-            except json.decoder.JSONDecodeError:
-                print("Error in JSON decoding:", response_txt) 
+            except orjson.JSONDecodeError:
+                print("Error in JSON decoding:", response_bytes) 
                 raise
 
-        error = response_obj["error"]
+        responses = response_obj if isinstance(response_obj, list) else [response_obj]
+        responses_by_id = {r["id"]: r for r in responses}
+
+        results = []
+        for request in requests:
+            response = responses_by_id[request["id"]]
+            error = response["error"]
 
-        if error != None:
-            raise BitcoindHttpException(error["code"], error["message"])
+            if error != None:
+                results.append(BitcoindHttpException(error["code"], error["message"]))
+            else:
+                results.append(response["result"])
             
-        return response_obj["result"]
+        return results
 
     async def get_raw_mempool(self, verbose= False):
         return await self._enqueue_http("getrawmempool", [verbose])
@@ -28,3 +28,13 @@ TARGETS_CONFIDENCE = [.5, .8, .9]
 TARGETS_MINUTE = [30, 60, 60*2, 60*3, 60*6, 60*12, 60*24]
 
 ######
+
+
+
+### Transaction summaries ###
+
+# Attempts to summarize a logged transaction before giving up on it
+# (e.g. when one of its parents can't be fetched anymore)
+SUMMARY_MAX_ATTEMPTS = 5
+
+######
@@ -1,7 +1,9 @@
 # Calculations and estimations of fees
 
-import scipy
-import scipy.stats
+import math
+import functools
+
+import numpy
 
 import constants
 
@@ -12,42 +14,83 @@ NAN = float('NaN')
 
 class FeeBuckets:
     """ Versatile class to store numerical data associated to different fee levels.
+        Values are kept in a dense array indexed by fee rate.
     """
 
     def __init__(self):
-        # TODO: use an array rather than a dict, to improve performance
-
         # Maps fee_rate => WU
-        self._buckets = {}
+        # Index 0 is never used since fee rates are normalized to [MIN_FEE_RATE, MAX_FEE_RATE]
+        self._w = numpy.zeros(constants.MAX_FEE_RATE + 1, dtype= numpy.int64)
+
+        # Cached suffix sums, invalidated on every mutation
+        self._suffix_cache = None
+
+        # Set by finalize()
+        self._finalized = False
 
     def _normalize(fee_rate):
         fee_rate = min(fee_rate, constants.MAX_FEE_RATE)
         fee_rate = max(fee_rate, constants.MIN_FEE_RATE)
 
-        return fee_rate
+        return int(fee_rate)
+
+    @staticmethod
+    def from_arrays(fee_rates, weights):
+        """ Returns a new FeeBuckets object holding the sum of *weights*
+            at their corresponding *fee_rates* (numpy arrays of the same length).
+        """
+
+        o = FeeBuckets()
+        fee_rates = numpy.clip(fee_rates, constants.MIN_FEE_RATE, constants.MAX_FEE_RATE)
+        numpy.add.at(o._w, fee_rates, weights)
+        return o
+
+    def _invalidate(self):
+        """ Must be called before any mutation. """
+
+        if self._finalized:
+            raise ValueError("FeeBuckets object is finalized and read-only")
+
+        self._suffix_cache = None
+
+    def finalize(self):
+        """ Precomputes aggregates and makes the object read-only. """
+
+        self._suffix()
+        self._w.flags.writeable = False
+        self._suffix_cache.flags.writeable = False
+        self._finalized = True
+
+    def _suffix(self):
+        """ Returns an array where index *i* holds the sum of all values
+            whose fee rate is greater than or equal to *i*.
+            The array has one extra trailing zero for fee rates above MAX_FEE_RATE.
+        """
+
+        if self._suffix_cache is None:
+            suffix = numpy.zeros(len(self._w) + 1, dtype= self._w.dtype)
+            suffix[:-1] = numpy.cumsum(self._w[::-1])[::-1]
+            self._suffix_cache = suffix
+
+        return self._suffix_cache
 
     
     def divide(self, factor):
         """ Divides all bucket's values by a factor """
-        for k in self._buckets:
-            self._buckets[k] /= factor
+        self._invalidate()
+        self._w = self._w / factor
 
     
     def clone(self):
         o = FeeBuckets()
-        o._buckets = self._buckets.copy()
+        o._w = self._w.copy()
         return o
 
     
     def sum(self):
         """Returns the sum of all bucket's values."""
 
-        value = 0
-
-        for k in self._buckets:
-            value += self._buckets[k]
-
-        return value
+        return self._w.sum().item()
 
     
     def get_aggregate_sup(self, threshold):
@@ -55,98 +98,99 @@ class FeeBuckets:
             or equal to *threshold*
         """
 
-        value = 0
-        for k in self._buckets:
-            if k >= threshold:
-                value += self._buckets[k]
-
-        return value
+        index = min(max(int(threshold), 0), constants.MAX_FEE_RATE + 1)
+        return self._suffix()[index].item()
 
     
     def max_fee_rate(self):
         """Returns the maximum fee rate with a non-zero value"""
 
-        keys = self._buckets.keys()
-        if len(keys) == 0:
-            return 0
-
-        return max(keys)
+        return int(numpy.flatnonzero(self._w).max(initial= 0))
 
     def add(self, other):
         """ Given another FeeBuckets object, add all of its values
             to our own values.
         """
 
-        for k in other._buckets:
-            self[k] += other[k]
+        self._invalidate()
+
+        # Not in-place, so that int buckets get promoted when adding float buckets
+        self._w = self._w + other._w
+
+    def add_weight(self, fee_rate, weight):
+        """ Adds *weight* to the bucket at *fee_rate*.
+            Faster than `buckets[fee_rate] += weight`, but *fee_rate* must already
+            be within [MIN_FEE_RATE, MAX_FEE_RATE] (as returned by *to_fee_rate()*).
+        """
+
+        self._invalidate()
+        self._w[fee_rate] += weight
 
     def descending_keys(self):
         """ Returns a list of all of our non-zero fee rates in descending order. """
-        keys = list(self._buckets.keys())
-        keys.sort(reverse=True)
-        return keys
+        return numpy.flatnonzero(self._w)[::-1].tolist()
 
     def ascending_keys(self):
         """ Returns a list of all of our non-zero fee rates in ascending order. """
-        keys = list(self._buckets.keys())
-        keys.sort()
-        return keys
+        return numpy.flatnonzero(self._w).tolist()
+
+    def to_dict(self):
+        """ Returns a dict of all non-zero fee rates => value, in ascending order. """
+        keys = numpy.flatnonzero(self._w)
+        return dict(zip(keys.tolist(), self._w[keys].tolist()))
 
     def __contains__(self, fee_rate):
         fee_rate = FeeBuckets._normalize(fee_rate)
-        return fee_rate in self._buckets and self._buckets[fee_rate] > 0
+        return self._w[fee_rate] > 0
 
     def __str__(self):
-        keys = list(self._buckets.keys())
-        keys.sort()
-        return ', '.join([str(k) + "=" + str(self[k]) for k in keys])
+        return ', '.join([str(k) + "=" + str(v) for (k, v) in self.to_dict().items()])
 
     def __getitem__(self, fee_rate):
         fee_rate = FeeBuckets._normalize(fee_rate)
-
-        if fee_rate in self._buckets: 
-            return self._buckets[fee_rate]
-        else:
-            return 0
+        return self._w[fee_rate].item()
 
     def __setitem__(self, fee_rate, value):
         fee_rate = FeeBuckets._normalize(fee_rate)
+        self._invalidate()
+
+        # Avoid silently truncating floats into the int array
+        if isinstance(value, float) and self._w.dtype.kind != 'f':
+            self._w = self._w.astype(numpy.float64)
 
-        if value == 0:
-            del self._buckets[fee_rate]
-        else:
-            self._buckets[fee_rate] = value  
+        self._w[fee_rate] = value
 
 
 
 
 def to_fee_rate(satoshis, weight):
     """ Computes a fee rate given a total fee in satoshis and a weight.
-        Outputs in sats/vbyte.
+        Outputs in sats/vbyte, within [MIN_FEE_RATE, MAX_FEE_RATE].
         Sats/vbyte are used instead of sats/WU in order to provide more granularity
     """
 
-    return int(4 * satoshis / weight) 
-
-def get_prob_of_min_blocks(minutes, blocks):
-    """ Returns the probability of finding more than *blocks* blocks. """
-    expected = minutes / constants.TARGET_BLOCK_TIME_MINUTES
-    return 1 - scipy.stats.poisson(expected).cdf(blocks)
+    fee_rate = int(4 * satoshis / weight)
+    return max(constants.MIN_FEE_RATE, min(constants.MAX_FEE_RATE, fee_rate))
 
+@functools.lru_cache(maxsize= None)
 def get_min_expected_blocks(minutes, target_prob):
     """ Returns the minimum number of blocks we can expect after *minutes*
         with *target_prob* probability.
     """
 
-    blocks = 0
+    expected = minutes / constants.TARGET_BLOCK_TIME_MINUTES
 
-    while True:
-        prob = get_prob_of_min_blocks(minutes, blocks)
+    # Accumulate the Poisson CDF one term at a time, until the
+    # probability of finding more blocks drops below target_prob.
+    # exp(-expected) doesn't underflow for the windows we use (a day is 144 blocks).
+    blocks = 0
+    term = math.exp(-expected)
+    cdf = term
 
-        if prob < target_prob:
-            break
-    
+    while 1 - cdf >= target_prob:
         blocks+= 1
+        term *= expected / blocks
+        cdf += term
 
     return blocks
 
@@ -159,6 +203,8 @@ def compute_bucket(minutes, confidence, start_weight, weight_incr_rate_per_min):
         weight_incr_rate_per_min -- WU being added to the bucket every minute.
 
         Returns True if the bucket became empty, False if it's still full.
+        *start_weight* and *weight_incr_rate_per_min* may also be numpy arrays
+        to simulate many buckets at once, in which case an array of booleans is returned.
     """
 
     # Maximum WU decrease per block = block capacity
@@ -177,22 +223,6 @@ def compute_bucket(minutes, confidence, start_weight, weight_incr_rate_per_min):
 
 
 
-def correction_decreasing_fees(estimates, list_windows, list_confidence):
-    """ Enforces decreasing fees as the confirmation window gets longer.
-
-        estimates       -- nested dict: delay -> confidence -> fee rate
-        list_windows    -- list of confirmation windows (in minutes or blocks, doesn't matter)
-        list_confidence -- list of confidence value
-    """
-
-    for confidence in list_confidence:
-        min_value = POSITIVE_INFINITY
-        for delay in list_windows:
-            value = estimates[delay][confidence]
-            min_value = min(min_value, value)
-            estimates[delay][confidence] = min_value
-
-
 def compute_estimates_by_minute(mempool, flow, targets_minute):
     """ Computes estimates by minute. 
         Same arguments as in *compute_estimates()*.
@@ -202,33 +232,37 @@ def compute_estimates_by_minute(mempool, flow, targets_minute):
     max_fee_rate_in_flow = max(map(lambda x: flow[x].max_fee_rate(), flow))
     max_fee_rate = max(mempool.max_fee_rate(), max_fee_rate_in_flow )
     
+    # Matrix of fee rates
+    # [minute index, confidence index] -> fee_rate
+    estimates = numpy.full((len(targets_minute), len(constants.TARGETS_CONFIDENCE)), POSITIVE_INFINITY)
+
+    # All candidate fee rates
+    fee_rates = numpy.arange(1, max_fee_rate+2)
+    start_weights = mempool._suffix()[fee_rates]
+
+    for (i, minutes) in enumerate(targets_minute):
+        weight_incr_rates = flow[minutes]._suffix()[fee_rates]
+
+        for (j, confidence) in enumerate(constants.TARGETS_CONFIDENCE):
+            # Run outcome simulations for all fee rates at once,
+            # then pick the first one that empties the bucket.
+            results = compute_bucket(minutes, confidence, start_weights, weight_incr_rates)
+            index = numpy.argmax(results)
+
+            if results[index]:
+                estimates[i, j] = fee_rates[index]
+
+    # Enforce decreasing fees as the confirmation window gets larger
+    estimates = numpy.minimum.accumulate(estimates, axis= 0)
+
     # Nested dicts
     # minute -> confidence -> fee_rate
     output = {}
-
-    for minutes in targets_minute:
+    for (i, minutes) in enumerate(targets_minute):
         output[minutes] = {}
-        for confidence in constants.TARGETS_CONFIDENCE:
-            min_fee_rate_that_works = POSITIVE_INFINITY
-            
-            # Iterate through all fee rates,
-            # run outcome simulations,
-            # then stop once we find one that empties the bucket.
-            for fee_rate in range(1, max_fee_rate+2):
-                result = compute_bucket(
-                    minutes, 
-                    confidence, 
-                    mempool.get_aggregate_sup(fee_rate), 
-                    flow[minutes].get_aggregate_sup(fee_rate)) 
-
-                if result:
-                    min_fee_rate_that_works = min(min_fee_rate_that_works, fee_rate)
-                    break
-
-            output[minutes][confidence] = min_fee_rate_that_works
-
-    # Enforce decreasing fees as the confirmation window gets larger
-    correction_decreasing_fees(output, targets_minute, constants.TARGETS_CONFIDENCE)
+        for (j, confidence) in enumerate(constants.TARGETS_CONFIDENCE):
+            value = estimates[i, j].item()
+            output[minutes][confidence] = int(value) if value != POSITIVE_INFINITY else POSITIVE_INFINITY
 
     return output
 
@@ -241,12 +275,19 @@ def compute_estimates(mempool, flow, targets_minute):
                    it must match the elements in *targets_minute*.
         targets_minute -- list of delays in minutes to compute estimates for ([30, 60, ...])
 
+        The mempool and flow FeeBuckets objects get finalized, and are read-only afterwards.
+
         Returns nested dictionaries that can be navigated as such:
         output["by_minute"][*delay in minutes*][*confidence*] = fee_rate
 
         *NOT IMPLEMENTED!*
         output["by_block"][*max delay in blocks*][*confidence*] = fee_rate
     """
+
+    mempool.finalize()
+    for minutes in flow:
+        flow[minutes].finalize()
+
     return {
         "by_minute": compute_estimates_by_minute(mempool, flow, targets_minute),
         "by_block": {"1": {"0.5": NAN, "0.8": NAN, "0.9": NAN}} # TODO
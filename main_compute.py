@@ -7,6 +7,7 @@ import sys
 import os
 import asyncio
 import pymongo
+import numpy
 
 import txdb
 import flow
@@ -16,6 +17,9 @@ import mongodb_client
 import constants
 
 
+# Before anything creates the event loop
+utils.install_uvloop()
+
 bitcoin_client = bitcoind.BitcoindClient.from_env_variables()
 
 
@@ -26,56 +30,66 @@ db_summaries = txdb.DbTxSummary(bitcoin_client, db)
 db_history = txdb.DbHistory(db)
 
 
-async def load_flow_from_db(seconds):
+async def load_flows_from_db(list_seconds):
     """ Computes flows over the last *seconds* of recorded
-        transactions.
+        transactions, for each *seconds* in *list_seconds*.
+        Weights are summed by fee rate in the DB, in a single
+        aggregation over the widest timespan.
 
-        Returns a flow.FeeBuckets object in WU/minute.
+        Returns a dict of *seconds* => flow.FeeBuckets object in WU/minute.
     """
 
-    print("Load flows over the last " + str(seconds / 60.0 / 60) + " hours...")
-    
-    results = []
-    async for i in db_txlog.fetch(seconds):
-        results.append(i)
+    max_seconds = max(list_seconds)
+    print("Load flows over the last " + str(max_seconds / 60.0 / 60) + " hours...")
 
-    print("Got " + str(len(results)) + " transactions from DB")
+    # The logger normally summarizes transactions as they come,
+    # catch up on those it missed (e.g. while it was down).
+    txids = await db_txlog.fetch_unsummarized(max_seconds)
+    print("Transactions without summary in DB: " + str(len(txids)))
+    await db_txlog.set_summaries(txids, await db_summaries.process(txids))
 
-    txids = list(map(lambda x: x.txid, results))
-    
-    o = await make_feebuckets_from_txids(txids, log=True)
-  
-    o.divide(seconds / 60)
+    weights = await db_txlog.aggregate_weights(list_seconds)
 
-    return o
+    flows = {}
+    for seconds in list_seconds:
+        weights_by_fee_rate = weights[seconds]
+        o = flow.FeeBuckets.from_arrays(
+            numpy.array(list(weights_by_fee_rate.keys()), dtype= numpy.int64),
+            numpy.array(list(weights_by_fee_rate.values()), dtype= numpy.int64)
+        )
+        o.divide(seconds / 60)
+        flows[seconds] = o
 
+    return flows
 
-async def make_feebuckets_from_txids(list_txid, log=False):
+
+async def make_feebuckets_from_txids(list_txid):
     """ Returns a flow.FeeBuckets object holding the sum of all
         the weight of transactions from a list of txid's.  
     """
-    output = flow.FeeBuckets()
-   
-    # Load transaction summaries
-    summaries = await db_summaries.process(list_txid)
+
+    # Load transaction summaries, without duplicates
+    summaries = await db_summaries.process(list(dict.fromkeys(list_txid)))
     print("Got summaries:", len(summaries))
 
-    # Add the weight of each tx to the relevant bucket
-    for txid in list_txid:
-        if txid not in summaries:
-            print("Summary not found", txid)
-            continue
+    return make_feebuckets_from_summaries(summaries.values())
 
-        tx_summary = summaries[txid]
+
+def make_feebuckets_from_summaries(tx_summaries):
+    """ Returns a flow.FeeBuckets object holding the sum of all
+        the weight of the given txdb.RecordTransactionSummary objects.
+        Summaries that are None are ignored.
+    """
+
+    output = flow.FeeBuckets()
+
+    # Add the weight of each tx to the relevant bucket
+    for tx_summary in tx_summaries:
         if tx_summary == None:
             continue 
         
-        fees = tx_summary.inputs - tx_summary.outputs
-        weight = tx_summary.weight
-
-        fee_rate = flow.to_fee_rate(fees, weight)
-
-        output[fee_rate] += weight 
+        fee_rate = flow.to_fee_rate(tx_summary.get_fees(), tx_summary.weight)
+        output.add_weight(fee_rate, tx_summary.weight)
         
     return output
 
@@ -94,6 +108,12 @@ async def load_mempool():
 async def main():
     start_time = time.time()
 
+    await asyncio.gather(
+        db_txlog.ensure_indexes(),
+        db_summaries.ensure_indexes(),
+        db_history.ensure_indexes()
+    )
+
     # Delete old transactions
     max_age_seconds = max(constants.TARGETS_MINUTE) * 60 * constants.FLOW_TIMESPAN_MULTIPLIER * 2
     print("Trim transactions older than " + str(max_age_seconds / 60 / 60 / 24) + " days")
@@ -102,10 +122,9 @@ async def main():
 
     
     # Load flows that will be used for each confirmation window
-    # TODO: smarter flow loading to avoid refetching the same data from the DB multiple times
-    buckets_flow = {}
-    for minutes in constants.TARGETS_MINUTE:
-        buckets_flow[minutes] = await load_flow_from_db(minutes * 60 * constants.FLOW_TIMESPAN_MULTIPLIER)
+    flow_seconds = {minutes: minutes * 60 * constants.FLOW_TIMESPAN_MULTIPLIER for minutes in constants.TARGETS_MINUTE}
+    flows = await load_flows_from_db(list(flow_seconds.values()))
+    buckets_flow = {minutes: flows[flow_seconds[minutes]] for minutes in constants.TARGETS_MINUTE}
 
     buckets_mempool = await load_mempool()
 
@@ -114,8 +133,8 @@ async def main():
     output = {
         "timestamp": int(time.time()),
         "estimates": estimates,
-        "flow": {(k * constants.FLOW_TIMESPAN_MULTIPLIER): buckets_flow[k]._buckets for k in buckets_flow},
-        "mempool": buckets_mempool._buckets
+        "flow": {(k * constants.FLOW_TIMESPAN_MULTIPLIER): buckets_flow[k].to_dict() for k in buckets_flow},
+        "mempool": buckets_mempool.to_dict()
     }
     output_json = json.dumps(output)
 
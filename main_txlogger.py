@@ -14,9 +14,11 @@ import os
 import time
 import socket
 
+import utils
 import bitcoind
 import txdb
 import mongodb_client
+import constants
 
 # It seems like hostname resolution doesn't work if we let the ZMQ lib resolve it,
 # so resolve it ourselves
@@ -24,20 +26,53 @@ BITCOIN_HOST =  socket.gethostbyname(os.getenv("BITCOIN_HOST", "127.0.0.1"))
 BITCOIN_ZMQ_PORT = int(os.getenv("BITCOIN_ZMQ_PORT"))
 ZMQ_URL = "tcp://" + BITCOIN_HOST + ":" + str(BITCOIN_ZMQ_PORT)
 
+# Notified transactions are logged in a single bulk insert
+# after this delay, or as soon as that many are waiting.
+TX_BATCH_DELAY_SECONDS = 0.1
+TX_BATCH_MAX_SIZE = 1000
+
+# Widest flow timespan used by the estimator
+FLOW_MAX_AGE_SECONDS = max(constants.TARGETS_MINUTE) * 60 * constants.FLOW_TIMESPAN_MULTIPLIER
+
+# Before anything creates the event loop
+utils.install_uvloop()
+
 bitcoin_client = bitcoind.BitcoindClient.from_env_variables()
 db = mongodb_client.load_from_env_variables()
 db_txlog = txdb.DbTxLog(db)
+db_summaries = txdb.DbTxSummary(bitcoin_client, db)
+
+
+
+async def summarize_transactions(txids):
+    """ Stores the fee rate and weight of the given txids in the log,
+        so that the estimator doesn't have to compute summaries itself.
+    """
+
+    summaries = await db_summaries.process(txids)
+    await db_txlog.set_summaries(txids, summaries)
 
 
+async def process_tx_notifications(batch):
+    """ Logs and summarizes the given list of RecordTransactionLog """
+
+    # Do not block the main loop if there's an issue, just log
+    try:
+        await db_txlog.insert_bulk(batch)
+        await summarize_transactions([i.txid for i in batch])
+    except Exception as e:
+        print("Exception in process_tx_notifications", e)
+
 
-async def process_tx_notification(txid):
-    """ Logs the given txid """
+async def summarize_log():
+    """ Summarizes logged transactions that haven't been yet. """
 
     # Do not block the main loop if there's an issue, just log
     try:
-        await db_txlog.insert(txid)
+        txids = await db_txlog.fetch_unsummarized(FLOW_MAX_AGE_SECONDS)
+        await summarize_transactions(txids)
     except Exception as e:
-        print("Exception in process_tx_notification", e)
+        print("Exception in summarize_log", e)
 
 
 class ZMQHandler():
@@ -55,6 +90,13 @@ class ZMQHandler():
         print("Open ZMQ socket on", ZMQ_URL)
         self.zmqSubSocket.connect(ZMQ_URL)
 
+        # Notified transactions waiting to be logged in a single bulk insert
+        self._pending = []
+        self._flush_handle = None
+
+        # Periodic catch-up summarization, see load_from_mempool()
+        self._summarize_task = None
+
     async def load_from_mempool(self):
         """ Polls Bitcoind's mempool and logs each transaction sitting there. """
 
@@ -69,16 +111,26 @@ class ZMQHandler():
 
         print("- Loaded transactions from mempool:", len(batch))
 
+        # Catch up on transactions that were missed by ZMQ, or whose summary failed
+        if self._summarize_task == None or self._summarize_task.done():
+            self._summarize_task = self.loop.create_task(summarize_log())
+
         # Call ourselves again sometime later.
         # This is to periodically poll the mempool state.
         # ZMQ should be considered as "unreliable" and might miss some notifications.
         self.loop.call_later(60, lambda: self.loop.create_task(self.load_from_mempool()))
     
 
-    async def handle(self) :
-        """ Handles the next ZMQ message. """
+    async def run_loop(self):
+        """ Receives and handles ZMQ messages. """
+
+        while True:
+            msg = await self.zmqSubSocket.recv_multipart()
+            self._dispatch(msg)
+
+    def _dispatch(self, msg):
+        """ Handles a ZMQ message. """
 
-        msg = await self.zmqSubSocket.recv_multipart()
         topic = msg[0]
         body = msg[1]
         sequence = "Unknown"
@@ -91,17 +143,49 @@ class ZMQHandler():
             txid = body.hex()
             print('- tx ('+sequence+') ', txid)
             
-            asyncio.create_task(process_tx_notification(txid))
+            # Log transactions in batches
+            self._pending.append(txdb.RecordTransactionLog(txid, int(time.time())))
+
+            if len(self._pending) >= TX_BATCH_MAX_SIZE:
+                self._flush()
+            elif self._flush_handle == None:
+                self._flush_handle = self.loop.call_later(TX_BATCH_DELAY_SECONDS, self._flush)
+
+    def _take_pending(self):
+        """ Returns all pending transactions and cancels the scheduled flush. """
 
-        # schedule ourselves to receive the next message
-        asyncio.ensure_future(self.handle())
+        batch = self._pending
+        self._pending = []
+
+        if self._flush_handle != None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        return batch
+
+    def _flush(self):
+        """ Logs all pending transactions. """
+
+        batch = self._take_pending()
+        if len(batch) > 0:
+            self.loop.create_task(process_tx_notifications(batch))
 
     def start(self):
+        self.loop.run_until_complete(asyncio.gather(
+            db_txlog.ensure_indexes(),
+            db_summaries.ensure_indexes()
+        ))
+
         self.loop.add_signal_handler(signal.SIGINT, self.stop)
         self.loop.create_task(self.load_from_mempool())
-        self.loop.create_task(self.handle())
+        self.loop.create_task(self.run_loop())
         self.loop.run_forever()
 
+        # Don't lose transactions that were waiting to be logged
+        batch = self._take_pending()
+        if len(batch) > 0:
+            self.loop.run_until_complete(process_tx_notifications(batch))
+
     def stop(self):
         self.loop.stop()
         self.zmqContext.destroy()
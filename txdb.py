@@ -4,10 +4,10 @@
 import time
 import os
 import datetime
-import json
 import pymongo
 import asyncio
 
+import flow
 import constants
 
 ### Database records
@@ -42,6 +42,10 @@ class RecordTransactionSummary():
         """ Total fees paid out to the miner in satoshis. """
         return self.inputs - self.outputs
 
+    def get_fee_rate(self):
+        """ Fee rate in sats/vbyte, see *flow.to_fee_rate()* """
+        return flow.to_fee_rate(self.get_fees(), self.weight)
+
     def to_document(self):
         """ Formats the record to be inserted in MongoDB. """
 
@@ -61,7 +65,14 @@ class DbTxLog:
 
     def __init__(self, mongo_db):
         self._collection = mongo_db["tx_log"]
-        self._collection.create_index("time")
+
+        # The log is ingest-only and refreshed from the mempool every minute,
+        # so bulk upserts don't need to wait for the journal.
+        self._ingest_collection = self._collection.with_options(write_concern= pymongo.WriteConcern(w= 1, j= False))
+
+    async def ensure_indexes(self):
+        """ Creates the indexes of the collection if they don't exist yet. """
+        await self._collection.create_index("time")
 
     async def trim(self, max_age_seconds):
         """ Removes older transactions 
@@ -79,13 +90,16 @@ class DbTxLog:
     async def insert_bulk(self, list_of_records):
         """ Inserts a list of multiple RecordTransactionLog. """
 
+        if len(list_of_records) == 0:
+            return
+
         # Map all records to upsert operations and update only if we got the earliest timestamp for each tx
         write_ops = [
             pymongo.UpdateOne({'_id': i.txid}, {'$min': {'time': i.timestamp}}, upsert= True) 
             for i in list_of_records
         ]
 
-        await self._collection.bulk_write(write_ops, ordered= False)
+        await self._ingest_collection.bulk_write(write_ops, ordered= False)
 
     async def fetch(self, max_age):
         """ Iterates through records that are no older than *max_age* seconds. """
@@ -96,6 +110,73 @@ class DbTxLog:
         async for doc in cursor:
             yield RecordTransactionLog(doc['_id'], doc['time'])
 
+    async def fetch_unsummarized(self, max_age):
+        """ Returns the txids of records that are no older than *max_age* seconds
+            and whose fee rate hasn't been set yet by *set_summaries()*,
+            unless summarizing them already failed SUMMARY_MAX_ATTEMPTS times.
+        """
+
+        now = int(time.time())
+        threshold = now - max_age
+        cursor = self._collection.find({
+            'time': {'$gte': threshold},
+            'fee_rate': {'$exists': False},
+            'summary_failures': {'$not': {'$gte': constants.SUMMARY_MAX_ATTEMPTS}}
+        }, projection= {'_id': 1})
+        return [doc['_id'] async for doc in cursor]
+
+    async def set_summaries(self, txids, summaries):
+        """ Stores the fee rate and weight of transactions alongside their record.
+
+            txids     -- list of txids given to *DbTxSummary.process()*, those missing
+                         from *summaries* failed and get retried by *fetch_unsummarized()*
+            summaries -- dict of txid => RecordTransactionSummary, or None if
+                         the transaction couldn't be found (it won't be retried).
+        """
+
+        write_ops = []
+        for (txid, tx_summary) in summaries.items():
+            if tx_summary == None:
+                update = {'fee_rate': None, 'weight': 0}
+            else:
+                update = {'fee_rate': tx_summary.get_fee_rate(), 'weight': tx_summary.weight}
+
+            write_ops.append(pymongo.UpdateOne({'_id': txid}, {'$set': update}))
+
+        failed = [txid for txid in txids if not txid in summaries]
+        if len(failed) > 0:
+            write_ops.append(pymongo.UpdateMany({'_id': {'$in': failed}}, {'$inc': {'summary_failures': 1}}))
+
+        if len(write_ops) == 0:
+            return
+
+        await self._ingest_collection.bulk_write(write_ops, ordered= False)
+
+    async def aggregate_weights(self, list_max_age):
+        """ Sums the weight of summarized transactions by fee rate, server-side,
+            over each timespan of *list_max_age* seconds in a single pass.
+
+            Returns a dict of *max_age* => dict of fee_rate => WU
+        """
+
+        now = int(time.time())
+        weight_sums = {
+            "w" + str(i): {"$sum": {"$cond": [{"$gte": ["$time", now - max_age]}, "$weight", 0]}}
+            for (i, max_age) in enumerate(list_max_age)
+        }
+        pipeline = [
+            {"$match": {"time": {"$gte": now - max(list_max_age)}, "fee_rate": {"$ne": None}}},
+            {"$group": {"_id": "$fee_rate", **weight_sums}}
+        ]
+
+        output = {max_age: {} for max_age in list_max_age}
+        async for doc in self._collection.aggregate(pipeline):
+            for (i, max_age) in enumerate(list_max_age):
+                if doc["w" + str(i)] > 0:
+                    output[max_age][doc["_id"]] = doc["w" + str(i)]
+
+        return output
+
 
 
 
@@ -108,24 +189,25 @@ class DbTxSummary():
     def __init__(self, bitcoin_client, mongo_db):
         self._bitcoind = bitcoin_client
         self._collection = mongo_db["tx_summary"]
-        self._collection.create_index("_cache_time", expireAfterSeconds= 60 * 60 * 24 * 2)
 
         # TODO: Replace the in-memory cache using a LRU
         #self._summary_cache = {}
 
+    async def ensure_indexes(self):
+        """ Creates the indexes of the collection if they don't exist yet. """
+        await self._collection.create_index("_cache_time", expireAfterSeconds= 60 * 60 * 24 * 2)
+
     async def _compute_input_sum(self, tx):
         """ Given a transaction dict, fetches all of its inputs and
             returns the sum (in satoshis). 
         """
 
-        # Find all input transaction ids
-        input_txids = map(lambda x: x["txid"], tx["vin"])
+        # Find all input transaction ids, without duplicates
+        input_txids = list({i["txid"] for i in tx["vin"]})
 
-        # Now load those
-        #TODO: in parallel
-        input_txs= {}
-        for iid in input_txids:
-            input_txs[iid] = await self._bitcoind.get_raw_transaction(iid, True)
+        # Now load those in parallel
+        fetched = await asyncio.gather(*(self._bitcoind.get_raw_transaction(iid, True) for iid in input_txids))
+        input_txs = dict(zip(input_txids, fetched))
 
         # Now we can compute the input sum
         input_sum = 0
@@ -170,8 +252,10 @@ class DbTxSummary():
 
     
     async def process(self, txid_list):
-        """ Given a list of txid's, returns a list
-            of RecordTransactionSummary() objects.
+        """ Given a list of txid's, returns a dict of txid => RecordTransactionSummary,
+            or None if the transaction couldn't be found.
+            Transactions that failed to be summarized (e.g. RPC errors) are left out,
+            so that they can be retried later.
         """
 
         # TODO: Refactor: method too big, split this in smaller methods.
@@ -185,77 +269,116 @@ class DbTxSummary():
 
         # Load summaries from the cache:
         print("DbTxSummary: fetch transactions in cache:", len(txid_list))
-        
-        queue_ids_to_load = list(txid_list) 
-        while len(queue_ids_to_load) > 0:
-              
-            cursor = self._collection.find({"_id": {"$in": queue_ids_to_load[:100000]}})
-            queue_ids_to_load = queue_ids_to_load[100000:]
+
+        # Small $in lists are much faster server-side, fetch those chunks in parallel
+        chunk_size = 1000
+
+        async def fetch_cached_chunk(txids):
+            cursor = self._collection.find(
+                {"_id": {"$in": txids}},
+                projection= {"weight": 1, "inputs": 1, "outputs": 1}
+            ).batch_size(chunk_size)
 
             async for doc in cursor:
                 records[doc["_id"]] = RecordTransactionSummary( doc["_id"], doc["weight"], doc["inputs"], doc["outputs"] )
 
+        await asyncio.gather(*(
+            fetch_cached_chunk(txid_list[i:i+chunk_size])
+            for i in range(0, len(txid_list), chunk_size)
+        ))
+
         print("DbTxSummary: transactions found in cache:", len(records))
 
 
 
         # Construct missing summaries that weren't found in the cache:
+
+        # Bounds the number of summaries being constructed at the same time
+        semaphore = asyncio.Semaphore(1000)
   
         async def construct_tx_summary(txid):
-            """ Compute a summary and insert in into the DB cache. """
-
-            tx_summary = await self._compute_tx_summary(txid)
-            records[txid] = tx_summary 
-            
-            if tx_summary != None:
-                await self._collection.insert_one(tx_summary.to_document())
-            return (txid, tx_summary)
+            """ Compute a summary, to be inserted later into the DB cache. """
 
-        count_constructed_summaries = 0
-        pending = []
+            async with semaphore:
+                tx_summary = await self._compute_tx_summary(txid)
+                records[txid] = tx_summary 
 
-        def any_done():
-            m = map(lambda x: x.done(), pending)
-            return any(m)
+            return tx_summary
 
         txid_to_construct = [txid for txid in txid_list if not txid in records]
 
         print("DbTxSummary: will construct transactions:", len(txid_to_construct))
 
         # Poll bitcoind for missing summaries
-        for txid in txid_to_construct:
-            count_constructed_summaries+= 1
-            
-            # TODO: Maybe rewrite this as a Queue?
-            # If there's too many pending tasks, block until at least one is done
-            if len(pending) > 1000:
-                while not any_done():
-                    await asyncio.sleep(0.1)
+        # One failing transaction must not throw away all the others
+        tasks = [asyncio.create_task(construct_tx_summary(txid)) for txid in txid_to_construct]
+        new_summaries = await asyncio.gather(*tasks, return_exceptions= True)
+
+        failed = [(txid, s) for (txid, s) in zip(txid_to_construct, new_summaries) if isinstance(s, Exception)]
+        if len(failed) > 0:
+            print("DbTxSummary: failed to construct transactions:", len(failed), "first error:", repr(failed[0][1]))
+
+        # Insert all new summaries into the DB cache at once
+        new_docs = [s.to_document() for s in new_summaries if isinstance(s, RecordTransactionSummary)]
+        if len(new_docs) > 0:
+            try:
+                await self._collection.insert_many(new_docs, ordered= False)
+
+            # Tolerate summaries that were inserted concurrently by another process
+            except pymongo.errors.BulkWriteError as e:
+                if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+                    raise
+
+        print("DbTxSummary: constructed: ", len(txid_to_construct) - len(failed))
+        print("DbTxSummary: done")
 
-                pending = [t for t in pending if not t.done()]
+        return records
 
-            pending.append( asyncio.create_task( construct_tx_summary(txid) ))
 
-        await asyncio.gather(*pending)
+def _stringify_keys(value):
+    """ Recursively converts dict keys to strings, as required in BSON documents.
+        Keys end up formatted the same way json.dumps() would.
+    """
 
-        print("DbTxSummary: constructed: ", count_constructed_summaries)
-        print("DbTxSummary: done")
+    if isinstance(value, dict):
+        return {str(k): _stringify_keys(v) for (k, v) in value.items()}
 
-        return records
+    return value
+
+
+def _confidence_field(confidence):
+    """ Field name of a confidence level in history documents, as a percentage
+        ("50" for 0.5): dots can't be used in field names addressed by queries.
+    """
+
+    return str(round(float(confidence) * 100))
 
 
 class DbHistory():
-    """ Collects historical estimates. """
+    """ Collects historical estimates.
+        Confidence levels are stored as percentages, see *_confidence_field()*:
+        e.g. estimates.by_minute.30.50 holds the 30 minutes estimate at 50% confidence.
+    """
 
     def __init__(self, mongo_db):
         self._collection = mongo_db["history"]
-        self._collection.create_index("timestamp")
+
+    async def ensure_indexes(self):
+        """ Creates the indexes of the collection if they don't exist yet. """
+        await self._collection.create_index("time")
 
     async def insert(self, output):
         """ output -- the estimates output to save """
 
-        output_json = json.dumps(output)
-        doc = {"time": output["timestamp"], "json": output_json}
+        estimates = {
+            kind: {
+                target: {_confidence_field(c): fee_rate for (c, fee_rate) in by_confidence.items()}
+                for (target, by_confidence) in by_target.items()
+            }
+            for (kind, by_target) in output["estimates"].items()
+        }
+
+        doc = {"time": output["timestamp"], **_stringify_keys({**output, "estimates": estimates})}
 
         await self._collection.insert_one(doc)
 
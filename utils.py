@@ -1,86 +1,454 @@
 import sys
 import asyncio
+import inspect
+import collections
+import itertools
+import concurrent.futures
+
+def install_uvloop():
+    """ Makes asyncio use uvloop's faster event loop, if uvloop is installed.
+        Must be called before any event loop gets created.
+        Returns True if uvloop is used.
+    """
+
+    try:
+        import uvloop
+    except ImportError:
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def _set_result(future, result):
+    """ Resolves a future, unless its client gave up on it. """
+
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, exception):
+    """ Fails a future, unless its client gave up on it.
+        Frames of the work queue are dropped from the traceback: their locals
+        (the batch, the queue...) would live as long as the future.
+    """
+
+    if not future.done():
+        tb = exception.__traceback__
+        while tb != None and tb.tb_frame.f_code in _WORK_QUEUE_CODES:
+            tb = tb.tb_next
+
+        future.set_exception(exception.with_traceback(tb))
+
 
 class WorkQueue():
-    """ Implements an asynchronous work queue, spawning a number of worker tasks
-        to apply a given processing function to all enqueued payloads. 
+    """ Implements an asynchronous work queue, spawning worker tasks on demand
+        to apply a given processing function to all enqueued payloads.
+
+        processing_func       -- coroutine or regular function called with each payload
+        batch_processing_func -- instead, called with up to *batch_size* payloads, returns their
+                                 results in order (Exception instances are raised to their caller)
+        executor              -- concurrent.futures.Executor to run regular functions in
+        gil_release           -- run regular functions in a thread pool of *workers* threads
+        is_async              -- overrides the detection of coroutine functions
+        max_queue_size        -- "auto" to hold *queue_multiplier* batches per worker
+        max_outstanding       -- bound on unresolved Futures, None for none
+        idle_timeout          -- seconds before idle workers exit, None to keep them
     """
 
-    def __init__(self, processing_func, max_queue_size = 1000, workers = 4):
+    # Workers yield to the event loop after processing that many payloads in a row
+    # without having to wait for new ones, see _work()
+    _yield_interval = 64
+
+    def __init__(self, processing_func = None, max_queue_size = "auto", workers = 4, batch_size = 1, queue_multiplier = 2,
+                 batch_processing_func = None, executor = None, idle_timeout = 60, gil_release = False,
+                 max_outstanding = None, is_async = None):
+        if (processing_func == None) == (batch_processing_func == None):
+            raise ValueError("Exactly one of processing_func or batch_processing_func is required")
+
+        if is_async == None:
+            func = processing_func if processing_func != None else batch_processing_func
+            is_async = inspect.iscoroutinefunction(func)
+
+        if gil_release and is_async:
+            raise ValueError("gil_release requires a regular processing function")
+
+        if executor != None and is_async:
+            raise ValueError("An executor requires a regular processing function")
+
+        if max_queue_size == "auto":
+            max_queue_size = queue_multiplier * workers * batch_size
+
         self._processing_func = processing_func
-        self._max_queue_size = max_queue_size
+        self._batch_processing_func = batch_processing_func
+        self._executor = executor
+
+        # Thread pool created by start() and shut down by stop()
+        self._gil_release = gil_release
+        self._owns_executor = False
+
+        # Regular functions are called as is, without wrapping them in a coroutine
+        self._is_sync = executor == None and not gil_release and not is_async
+
+        self._max_queue_size = max(1, workers, max_queue_size)
         self._workers = workers
+        self._batch_size = batch_size
+        self._idle_timeout = idle_timeout
         self._worker_tasks = []
+        self._worker_ids = itertools.count()
+
+        # Workers currently processing a batch, the others are waiting for payloads
+        self._busy_workers = 0
+
+        # Event loop the workers run on, captured once by _get_loop()
+        self._loop = None
+
+        # Plain deque rather than an asyncio.Queue, whose get()/put() create
+        # waiter futures on every call. Semaphores count free slots and
+        # available payloads, and only create waiters when they have to block.
+        self._items = collections.deque()
+        self._capacity = asyncio.Semaphore(self._max_queue_size)
+        self._available = asyncio.Semaphore(0)
+
+        # Released when payloads are processed, see _task_done()
+        self._outstanding = None if max_outstanding == None else asyncio.Semaphore(max(1, max_outstanding))
 
-        self._queue = asyncio.Queue(maxsize= max_queue_size)
+        # Payloads enqueued but not processed yet, see join()
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
     
-        self._running = False
+        # Set between start() and stop(), allows enqueue() to spawn workers
+        self._started = False
+
+        # Set by stop() until the next start(): payloads enqueued meanwhile get cancelled
+        self._closed = False
 
 
     async def _work(self, worker_id):
         """ Processing loop of a worker.
         """
 
-        while self._running:
+        # Payloads processed since the worker last had to wait for one
+        streak = 0
+
+        # Runs until cancelled by stop(), or idle for too long
+        while True:
+            # With payloads always waiting and processing functions that complete
+            # without suspending (e.g. cached results), the worker would never give
+            # control back to the event loop. Yield now and then, but only then.
+            if self._available.locked():
+                streak = 0
+            elif streak >= self._yield_interval:
+                streak = 0
+                await asyncio.sleep(0)
+
             try:
-                (item, future) = await self._queue.get()
-                
-                result = await self._processing_func(item)
-                future.set_result(result)
-                self._queue.task_done()
+                await self._wait_for_payload()
+
+            except asyncio.TimeoutError:
+                # enqueue() spawns a new worker when needed. Payloads that came
+                # in while timing out would otherwise wait for the next enqueue().
+                self._worker_tasks.remove(asyncio.current_task())
+                self._maybe_spawn()
+                return
+
+            self._busy_workers += 1
+            batch = [self._items.popleft()]
+            streak += 1
+            try:
+                # Take more payloads if they're already waiting,
+                # unless other workers are waiting for them
+                while len(batch) < self._batch_size and not self._available.locked():
+                    await self._available.acquire()
+                    batch.append(self._items.popleft())
+                    streak += 1
+
+                for _ in batch:
+                    self._capacity.release()
 
-            # Catch Cancelled exceptions to avoid forwarding them to future.set_exception()
+                await self._process_batch(batch)
+
+            # Whether stop() cancelled the worker or the processing function raised it
+            # on its own, clients waiting for the batch get cancelled. Only keep going
+            # in the latter case.
             except asyncio.CancelledError:
+                for (item, future) in batch:
+                    future.cancel()
+
+                if asyncio.current_task().cancelling():
+                    raise
+
+            except Exception as e:
+                for (item, future) in batch:
+                    _set_exception(future, e)
+
+            # KeyboardInterrupt, SystemExit...: let them stop the event loop,
+            # without leaving clients waiting for payloads that won't be processed
+            except BaseException:
+                for (item, future) in batch:
+                    future.cancel()
                 raise
 
-            except BaseException as e:
-                future.set_exception(e)
-                self._queue.task_done()
+            finally:
+                self._busy_workers -= 1
+                self._task_done(len(batch))
+
+
+    async def _wait_for_payload(self):
+        """ Acquires one permit of _available, i.e. one payload in the queue.
+            Raises asyncio.TimeoutError after *idle_timeout* seconds without payloads.
+        """
+
+        # wait_for() wraps the wait in a new task, only pay for it when we have to block
+        if self._idle_timeout == None or not self._available.locked():
+            await self._available.acquire()
+        else:
+            await asyncio.wait_for(self._available.acquire(), self._idle_timeout)
+
+
+    async def _process_batch(self, batch):
+        """ Processes a list of (payload, future) and resolves the futures. """
+
+        if self._batch_processing_func != None:
+            items = [item for (item, future) in batch]
+            if self._is_sync:
+                results = self._batch_processing_func(items)
+
+                # Not declared async, but returned an awaitable anyway (e.g. a lambda around a coroutine)
+                if inspect.isawaitable(results):
+                    results = await results
+            else:
+                results = await self._call(self._batch_processing_func, items)
+
+            # zip() would silently leave the extra futures unresolved
+            if len(results) != len(batch):
+                raise ValueError("batch_processing_func returned " + str(len(results)) + " results for " + str(len(batch)) + " payloads")
+
+            for ((item, future), result) in zip(batch, results):
+                if isinstance(result, Exception):
+                    _set_exception(future, result)
+                else:
+                    _set_result(future, result)
+
+            return
+
+        for (item, future) in batch:
+            try:
+                if self._is_sync:
+                    result = self._processing_func(item)
+                    if inspect.isawaitable(result):
+                        result = await result
+
+                    _set_result(future, result)
+                else:
+                    _set_result(future, await self._call(self._processing_func, item))
+
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+
+                future.cancel()
+
+            except Exception as e:
+                _set_exception(future, e)
          
 
+    async def _call(self, func, arg):
+        """ Calls a processing function, in the executor if there's one. """
+
+        if self._executor != None:
+            return await self._loop.run_in_executor(self._executor, func, arg)
+
+        return await func(arg)
+
+
+    def _get_loop(self):
+        """ Returns the event loop of the queue, capturing it on first use. """
+
+        if self._loop is None:
+            try:
+                self._loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self._loop = asyncio.get_event_loop()
+
+        return self._loop
+
+
+    def _task_done(self, count):
+        """ Marks *count* payloads as processed.
+            Called once per batch, right after its futures got resolved: this
+            doesn't schedule anything, resolving futures is the only hop to the
+            event loop, and _finished is only set when the queue runs empty.
+        """
+
+        self._unfinished -= count
+        if self._outstanding != None:
+            for _ in range(count):
+                self._outstanding.release()
+
+        if self._unfinished == 0:
+            self._finished.set()
+
+
     def is_running(self):
-        """ Returns True if the workers are currently running. """
+        """ Returns True if some workers are currently running.
+            Workers are spawned on demand, so a started queue may have none.
+        """
 
-        return self._running
+        return any(not task.done() for task in self._worker_tasks)
 
 
     async def join(self):
         """ Waits until all payloads in the queue have been processed. """
 
-        return await self._queue.join()
+        await self._finished.wait()
 
 
     def start(self):
-        """ Starts all workers. """
+        """ Allows workers to run. They are spawned as payloads get enqueued. """
+
+        if self._started:
+            return
+
+        self._started = True
+        self._closed = False
+
+        if self._gil_release and self._executor == None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers= self._workers)
+            self._owns_executor = True
+
+        # Captured now for enqueue_threadsafe(), workers may not exist yet
+        self._get_loop()
+
+        # Payloads may have been enqueued before starting
+        self._maybe_spawn()
+
 
-        if self._running:
+    def _maybe_spawn(self):
+        """ Spawns workers while there are more payloads waiting than idle workers. """
+
+        while (self._started and len(self._worker_tasks) < self._workers
+               and len(self._items) > len(self._worker_tasks) - self._busy_workers):
+            self._spawn_worker(next(self._worker_ids))
+
+
+    def _spawn_worker(self, worker_id):
+        """ Starts a worker task, supervised by *_on_worker_done()*. """
+
+        task = self._get_loop().create_task(self._work(worker_id))
+        task.add_done_callback(lambda t: self._on_worker_done(worker_id, t))
+        self._worker_tasks.append(task)
+
+
+    def _on_worker_done(self, worker_id, task):
+        """ Forgets about a worker that exited. Workers that died from an
+            unexpected exception or cancellation get replaced when needed.
+        """
+
+        # stop() awaits its workers, idle workers remove themselves
+        if not self._started or task not in self._worker_tasks:
             return
 
-        self._running = True
+        self._worker_tasks.remove(task)
+
+        # Cancellations are expected when the event loop tears down its tasks
+        if not task.cancelled():
+            if not isinstance(task.exception(), Exception):
+                return
+
+            print("WorkQueue: worker", worker_id, "died from exception:", repr(task.exception()))
 
-        for i in range(self._workers):
-            task = asyncio.get_event_loop().create_task(self._work(i))
-            self._worker_tasks.append(task)
+        # Replacements get a new id, and only if payloads are waiting
+        self._maybe_spawn()
 
 
     async def stop(self):
-        """ Stops all workers. """
+        """ Stops all workers and waits for them to exit.
+            Payloads that weren't processed get their Future cancelled.
+        """
 
-        self._running = False
+        self._started = False
+        self._closed = True
         for task in self._worker_tasks:
             task.cancel()
 
+        # Awaiting the tasks releases their frames and retrieves their exceptions
+        await asyncio.gather(*self._worker_tasks, return_exceptions= True)
+        self._worker_tasks.clear()
+
+        # No worker is left waiting for them, so these permits are taken right away
+        count = len(self._items)
+        for _ in range(count):
+            await self._available.acquire()
+            (item, future) = self._items.popleft()
+            future.cancel()
+            self._capacity.release()
+
+        self._task_done(count)
+
+        # Calls still running in threads complete on their own
+        if self._owns_executor:
+            self._executor.shutdown(wait= False)
+            self._executor = None
+            self._owns_executor = False
+
 
     async def enqueue(self, payload):
         """ Enqueues a new payload to be processed.
             Will wait if the queue is full until the payload can enter the queue.
-            Returns a Future that can later be awaited to watch for processing completion.
+            Returns a Future that can later be awaited to watch for processing completion,
+            cancelled if the queue gets stopped before the payload could enter it.
         """
 
-        future = asyncio.get_event_loop().create_future()
-        await self._queue.put((payload, future))
+        # A fresh Future is needed per payload: asyncio's C-implemented Futures
+        # can't be reset once done (their state is read-only), so they can't be pooled.
+        future = self._get_loop().create_future()
+
+        if self._outstanding != None:
+            await self._outstanding.acquire()
+
+        # All workers share a single queue: everything runs on one event loop so
+        # there is no lock contention, and it keeps batches as full as possible.
+        try:
+            await self._capacity.acquire()
+        except asyncio.CancelledError:
+            if self._outstanding != None:
+                self._outstanding.release()
+            raise
+
+        # Producers that were waiting for a slot when the queue got stopped
+        if self._closed:
+            self._capacity.release()
+            if self._outstanding != None:
+                self._outstanding.release()
+
+            future.cancel()
+            return future
+
+        self._items.append((payload, future))
+        self._unfinished += 1
+        self._finished.clear()
+        self._available.release()
+        self._maybe_spawn()
 
         # Do not await here! The client will await when it wants to
-        return future 
+        return future
+
+
+    def enqueue_threadsafe(self, payload):
+        """ Enqueues a new payload from a thread other than the event loop's.
+            Returns a concurrent.futures.Future holding the processing result.
+        """
+
+        if self._loop is None:
+            raise RuntimeError("WorkQueue must be started before enqueuing from other threads")
+
+        async def enqueue_and_wait():
+            return await (await self.enqueue(payload))
+
+        return asyncio.run_coroutine_threadsafe(enqueue_and_wait(), self._loop)
 
 
+# Code of the WorkQueue methods that processing function calls go through
+_WORK_QUEUE_CODES = {WorkQueue._work.__code__, WorkQueue._process_batch.__code__, WorkQueue._call.__code__}